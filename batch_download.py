@@ -5,19 +5,37 @@
 從相簿列表頁面提取所有章節連結，依序下載並生成 PDF。
 """
 import argparse
+import os
 import re
 import sys
+import threading
 import time
-import random
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
 from dataclasses import dataclass
 
-from playwright.sync_api import sync_playwright, Page, Browser
-from descrambler import restore_image
-from scraper import get_random_user_agent, download_image, _scroll_page
+from descrambler import get_num_batch, restore_and_save
+from scraper import (
+    BrowserSession,
+    ImageInfo,
+    RateLimiter,
+    download_image,
+    download_image_to_file,
+    scrape_album,
+    _scroll_page,
+)
 from to_pdf import images_to_pdf
 
 
+# 檔名中不允許的特殊字元
+_UNSAFE_CHARS_RE = re.compile(r'[<>:"|?*]')
+
+# 從章節連結提取 photo_id
+_PHOTO_HREF_RE = re.compile(r'/photo/(\d+)')
+
+
 def sanitize_filename(name: str) -> str:
     """
     清理檔名/目錄名稱，防止路徑遍歷攻擊。
@@ -33,7 +51,7 @@ def sanitize_filename(name: str) -> str:
     # 移除所有斜線
     name = name.replace('/', '_').replace('\\', '_')
     # 移除特殊字元
-    name = re.sub(r'[<>:"|?*]', '_', name)
+    name = _UNSAFE_CHARS_RE.sub('_', name)
     # 移除開頭的點和空格
     name = name.lstrip('. ')
     # 移除結尾的點和空格
@@ -53,51 +71,34 @@ class ChapterInfo:
     episode_num: int  # 話數編號
 
 
-def extract_album_chapters(url: str, headless: bool = True) -> tuple[str, list[ChapterInfo]]:
+def extract_album_chapters(url: str, session: BrowserSession) -> tuple[str, list[ChapterInfo]]:
     """
     從相簿頁面提取所有章節連結。
     
     Args:
         url: 相簿頁面 URL（如 https://18comic.vip/album/1223474/）
-        headless: 是否使用無頭模式
+        session: 已啟動的瀏覽器工作階段
     
     Returns:
         tuple[str, list[ChapterInfo]]: (相簿標題, 章節列表)
     """
-    with sync_playwright() as p:
-        browser: Browser = p.chromium.launch(headless=headless)
-        context = browser.new_context(
-            user_agent=get_random_user_agent(),
-            viewport={"width": 1920, "height": 1080},
-        )
-        
-        page: Page = context.new_page()
-        page.set_extra_http_headers({
-            "Referer": "https://18comic.vip/",
-            "Accept-Language": "zh-TW,zh;q=0.9,en-US;q=0.8,en;q=0.7",
-        })
-        
+    page, context = session.new_page()
+    try:
         # 訪問頁面
         page.goto(url, wait_until="domcontentloaded", timeout=60000)
         
-        # 等待並捲動以載入所有內容
-        page.wait_for_timeout(2000)
-        _scroll_page(page, scroll_times=5, delay_ms=500)
+        # 捲動直到章節連結數量穩定，以載入所有內容
+        _scroll_page(page, selector='a[href*="/photo/"]')
         
-        # 提取相簿標題
-        album_title = page.evaluate("""
+        # 提取相簿標題與所有章節連結（單次 evaluate）
+        page_data = page.evaluate("""
             () => {
                 const h1 = document.querySelector('h1');
-                return h1 ? h1.textContent.trim() : 'Unknown';
-            }
-        """)
-        
-        # 提取所有章節連結
-        raw_chapters = page.evaluate("""
-            () => {
+                const title = h1 ? h1.textContent.trim() : 'Unknown';
+                
                 const links = Array.from(document.querySelectorAll('a[href*="/photo/"]'));
                 const seen = new Set();
-                const results = [];
+                const chapters = [];
                 
                 for (const a of links) {
                     const href = a.getAttribute('href');
@@ -110,14 +111,17 @@ def extract_album_chapters(url: str, headless: bool = True) -> tuple[str, list[C
                     // 跳過空文字或太短的連結（可能是按鈕）
                     if (!text || text.length < 2) continue;
                     
-                    results.push({ text, href });
+                    chapters.push({ text, href });
                 }
                 
-                return results;
+                return { title, chapters };
             }
         """)
-        
-        browser.close()
+    finally:
+        context.close()
+    
+    album_title = page_data["title"]
+    raw_chapters = page_data["chapters"]
     
     # 解析章節資訊
     chapters = []
@@ -133,7 +137,7 @@ def extract_album_chapters(url: str, headless: bool = True) -> tuple[str, list[C
             continue
         
         # 提取 photo_id
-        match = re.search(r'/photo/(\d+)', href)
+        match = _PHOTO_HREF_RE.search(href)
         if not match:
             continue
         
@@ -153,26 +157,151 @@ def extract_album_chapters(url: str, headless: bool = True) -> tuple[str, list[C
     return album_title, chapters
 
 
-def download_chapter_images(
+class ImagePipeline:
+    """
+    圖片下載與還原的兩段式管線。
+    
+    下載（I/O）與還原+儲存（CPU）分別在不同的執行緒池執行，
+    下載執行緒不必等待圖片編碼即可繼續下一個請求；Pillow 在解碼/編碼時
+    會釋放 GIL，因此還原可在多核心上並行。還原佇列有上限，
+    CPU 或磁碟較慢時會反壓下載端，避免下載好的資料堆積在記憶體中。
+    """
+    
+    def __init__(self, workers: int, delay: float):
+        """
+        Args:
+            workers: 並行下載數
+            delay: 平均下載間隔（秒），0 表示不限速
+        """
+        restore_workers = os.cpu_count() or 1
+        self.limiter = RateLimiter(1 / delay, burst=workers) if delay > 0 else None
+        self._download_pool = ThreadPoolExecutor(max_workers=workers)
+        self._restore_pool = ThreadPoolExecutor(max_workers=restore_workers)
+        self._restore_slots = threading.BoundedSemaphore(restore_workers * 2)
+    
+    def submit(
+        self,
+        img_info: ImageInfo,
+        aid: int,
+        num_segments: int,
+        chapter_dir: Path,
+        referer: str,
+    ) -> Future:
+        """
+        送出單張圖片的下載工作。
+        
+        Args:
+            img_info: 圖片資訊
+            aid: 相簿 ID
+            num_segments: 圖片的分段數（0 表示不需解混淆）
+            chapter_dir: 章節圖片目錄
+            referer: Referer header
+        
+        Returns:
+            Future: 下載工作；結果為後續的還原工作（無需還原時為 None）
+        """
+        return self._download_pool.submit(
+            self._download_one, img_info, aid, num_segments, chapter_dir, referer
+        )
+    
+    @staticmethod
+    def wait_all(futures: list[Future]) -> None:
+        """等待 submit 送出的圖片全部下載並儲存完成"""
+        wait(futures)
+        restores = []
+        for future in futures:
+            if future.cancelled():
+                continue
+            restore = future.result()
+            if restore is not None:
+                restores.append(restore)
+        wait(restores)
+    
+    def shutdown(self) -> None:
+        """關閉執行緒池，並取消尚未開始的工作"""
+        self._download_pool.shutdown(cancel_futures=True)
+        self._restore_pool.shutdown(cancel_futures=True)
+    
+    def _download_one(
+        self,
+        img_info: ImageInfo,
+        aid: int,
+        num_segments: int,
+        chapter_dir: Path,
+        referer: str,
+    ) -> Future | None:
+        """下載單張圖片（於下載執行緒中執行），需要還原時轉交還原執行緒池"""
+        output_filename = f"{img_info.index:04d}_{img_info.photo_id}.webp"
+        output_path = chapter_dir / output_filename
+        
+        # 檢查是否已存在
+        if output_path.exists():
+            return None
+        
+        try:
+            if self.limiter is not None:
+                self.limiter.acquire()
+            
+            if num_segments == 0:
+                # 不需解混淆：直接寫入檔案（WebP 以串流寫入，其他格式轉存為 WebP）
+                download_image_to_file(img_info.url, output_path, referer=referer)
+                print(f"   ✓ {img_info.photo_id}")
+                return None
+            
+            scrambled_data = download_image(img_info.url, referer=referer)
+        except Exception as e:
+            print(f"   ✗ {img_info.photo_id}: {e}")
+            return None
+        
+        # 等待還原佇列有空位（反壓）
+        self._restore_slots.acquire()
+        try:
+            return self._restore_pool.submit(
+                self._restore_one, scrambled_data, aid, num_segments, img_info, output_path
+            )
+        except BaseException:
+            self._restore_slots.release()
+            raise
+    
+    def _restore_one(
+        self,
+        scrambled_data: bytes,
+        aid: int,
+        num_segments: int,
+        img_info: ImageInfo,
+        output_path: Path,
+    ) -> None:
+        """還原並儲存單張圖片（於還原執行緒中執行）"""
+        try:
+            restore_and_save(scrambled_data, aid, img_info.photo_id, output_path, num_segments)
+            print(f"   ✓ {img_info.photo_id}")
+        except Exception as e:
+            print(f"   ✗ {img_info.photo_id}: {e}")
+        finally:
+            self._restore_slots.release()
+
+
+def submit_chapter_images(
     chapter: ChapterInfo,
     output_dir: Path,
-    headless: bool = True,
-    delay: float = 0.3,
-) -> Path:
+    session: BrowserSession,
+    pipeline: ImagePipeline,
+) -> tuple[Path, list[Future]]:
     """
-    下載單一章節的所有圖片。
+    爬取單一章節的圖片列表，並將所有圖片交給下載管線。
+    
+    取得圖片列表後立即返回、不等待下載完成，讓主執行緒可以接著爬取
+    下一個章節；各章節共用同一個管線與限速器。
     
     Args:
         chapter: 章節資訊
         output_dir: 輸出目錄
-        headless: 是否使用無頭模式
-        delay: 下載間隔
+        session: 已啟動的瀏覽器工作階段
+        pipeline: 圖片下載管線
     
     Returns:
-        Path: 圖片儲存目錄
+        tuple[Path, list[Future]]: (圖片儲存目錄, 各圖片的下載工作)
     """
-    from scraper import scrape_album
-    
     # 建立章節目錄
     chapter_dir = output_dir / f"ep{chapter.episode_num:03d}_{chapter.photo_id}"
     chapter_dir.mkdir(exist_ok=True)
@@ -181,30 +310,50 @@ def download_chapter_images(
     print(f"   URL: {chapter.url}")
     
     # 爬取圖片列表
-    album = scrape_album(chapter.url, headless=headless)
+    album = scrape_album(chapter.url, session)
     print(f"   找到 {len(album.images)} 張圖片")
     
-    # 下載並還原每張圖片
-    for img_info in album.images:
-        output_filename = f"{img_info.index:04d}_{img_info.photo_id}.webp"
-        output_path = chapter_dir / output_filename
-        
-        # 檢查是否已存在
-        if output_path.exists():
-            continue
-        
-        try:
-            # 下載並還原
-            scrambled_data = download_image(img_info.url, referer=chapter.url)
-            restored_img = restore_image(scrambled_data, album.aid, img_info.photo_id)
-            restored_img.save(output_path)
-            print(f"   ✓ {img_info.photo_id}")
-        except Exception as e:
-            print(f"   ✗ {img_info.photo_id}: {e}")
-        
-        time.sleep(delay + random.uniform(0, 0.2))
+    # 一次算好整個章節的分段數，再交給管線並行下載並還原每張圖片
+    segments = get_num_batch(album.aid, [img.photo_id for img in album.images])
+    futures = [
+        pipeline.submit(img_info, album.aid, num_segments, chapter_dir, chapter.url)
+        for img_info, num_segments in zip(album.images, segments)
+    ]
     
-    return chapter_dir
+    return chapter_dir, futures
+
+
+def finish_chapter(
+    chapter: ChapterInfo,
+    chapter_dir: Path,
+    futures: list[Future],
+    pdf_dir: Path,
+) -> Path | None:
+    """
+    等待章節的圖片全部下載完成，並決定要生成的 PDF。
+    
+    PDF 由呼叫端交給背景行程生成，不阻塞後續章節的下載。
+    
+    Args:
+        chapter: 章節資訊
+        chapter_dir: 章節圖片目錄
+        futures: 該章節的圖片下載工作
+        pdf_dir: PDF 輸出目錄
+    
+    Returns:
+        Path | None: 要生成的 PDF 路徑（PDF 已存在時為 None）
+    """
+    ImagePipeline.wait_all(futures)
+    
+    # 生成 PDF
+    pdf_filename = f"ep{chapter.episode_num:03d}.pdf"
+    pdf_path = pdf_dir / pdf_filename
+    
+    if pdf_path.exists():
+        return None
+    
+    print(f"   📄 生成 PDF: {pdf_filename}")
+    return pdf_path
 
 
 def main():
@@ -232,7 +381,19 @@ def main():
         "--delay",
         type=float,
         default=0.3,
-        help="每張圖片下載間隔秒數（預設：0.3）",
+        help="每張圖片平均下載間隔秒數，0 表示不限速（預設：0.3）",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="同時下載的圖片數（預設：4）",
+    )
+    parser.add_argument(
+        "--chapters",
+        type=int,
+        default=2,
+        help="同時處理的章節數，下載前面章節時先爬取後續章節（預設：2）",
     )
     parser.add_argument(
         "--start-from",
@@ -256,67 +417,106 @@ def main():
     print(f"🔍 正在解析相簿: {args.album_url}")
     
     try:
-        # 提取章節列表
-        album_title, chapters = extract_album_chapters(args.album_url, headless=args.headless)
-        
-        print(f"\n📚 相簿標題: {album_title}")
-        print(f"📖 共 {len(chapters)} 個章節（已過濾休刊公告）")
-        
-        if not chapters:
-            print("❌ 未找到任何章節")
-            sys.exit(1)
-        
-        # 建立相簿目錄
-        # 清理標題中的特殊字元（防止路徑遍歷攻擊）
-        safe_title = sanitize_filename(album_title)
-        album_dir = output_dir / safe_title
-        album_dir.mkdir(exist_ok=True)
-        
-        images_dir = album_dir / "images"
-        images_dir.mkdir(exist_ok=True)
-        
-        pdf_dir = album_dir / "pdf"
-        pdf_dir.mkdir(exist_ok=True)
-        
-        # 篩選要下載的章節
-        chapters_to_download = [
-            ch for ch in chapters
-            if ch.episode_num >= args.start_from
-            and (args.end_at is None or ch.episode_num <= args.end_at)
-        ]
-        
-        print(f"\n⬇️  將下載 {len(chapters_to_download)} 個章節")
-        print(f"   圖片目錄: {images_dir}")
-        print(f"   PDF 目錄: {pdf_dir}")
-        
-        # 依序下載每個章節
-        for chapter in chapters_to_download:
+        # 整個流程共用同一個瀏覽器
+        with BrowserSession(headless=args.headless) as session:
+            # 提取章節列表
+            album_title, chapters = extract_album_chapters(args.album_url, session)
+            
+            print(f"\n📚 相簿標題: {album_title}")
+            print(f"📖 共 {len(chapters)} 個章節（已過濾休刊公告）")
+            
+            if not chapters:
+                print("❌ 未找到任何章節")
+                sys.exit(1)
+            
+            # 建立相簿目錄
+            # 清理標題中的特殊字元（防止路徑遍歷攻擊）
+            safe_title = sanitize_filename(album_title)
+            album_dir = output_dir / safe_title
+            album_dir.mkdir(exist_ok=True)
+            
+            images_dir = album_dir / "images"
+            images_dir.mkdir(exist_ok=True)
+            
+            pdf_dir = album_dir / "pdf"
+            pdf_dir.mkdir(exist_ok=True)
+            
+            # 篩選要下載的章節
+            chapters_to_download = [
+                ch for ch in chapters
+                if ch.episode_num >= args.start_from
+                and (args.end_at is None or ch.episode_num <= args.end_at)
+            ]
+            
+            print(f"\n⬇️  將下載 {len(chapters_to_download)} 個章節")
+            print(f"   圖片目錄: {images_dir}")
+            print(f"   PDF 目錄: {pdf_dir}")
+            
+            pipeline = ImagePipeline(workers=args.workers, delay=args.delay)
+            pdf_workers = max(2, (os.cpu_count() or 1) // 2)
+            pdf_pool = ProcessPoolExecutor(max_workers=pdf_workers)
+            pdf_jobs: list[tuple[ChapterInfo, Path, Path, Future]] = []
+            
+            # 爬取下一個章節的同時，前面章節的圖片在執行緒池中下載
+            in_flight: deque[tuple[ChapterInfo, Path, list[Future]]] = deque()
+            
+            def submit_pdf(chapter_dir: Path, pdf_path: Path) -> Future:
+                # 工作行程異常結束（如被 OOM 終止）會讓整個行程池失效，重建後再送出
+                nonlocal pdf_pool
+                try:
+                    return pdf_pool.submit(images_to_pdf, chapter_dir, pdf_path)
+                except BrokenProcessPool:
+                    pdf_pool.shutdown(cancel_futures=True)
+                    pdf_pool = ProcessPoolExecutor(max_workers=pdf_workers)
+                    return pdf_pool.submit(images_to_pdf, chapter_dir, pdf_path)
+            
+            def finish_next() -> None:
+                chapter, chapter_dir, futures = in_flight.popleft()
+                try:
+                    pdf_path = finish_chapter(chapter, chapter_dir, futures, pdf_dir)
+                    if pdf_path is not None:
+                        pdf_jobs.append((chapter, chapter_dir, pdf_path, submit_pdf(chapter_dir, pdf_path)))
+                except Exception as e:
+                    print(f"   ❌ 第 {chapter.episode_num} 話錯誤: {e}")
+            
             try:
-                # 下載圖片
-                chapter_image_dir = download_chapter_images(
-                    chapter,
-                    images_dir,
-                    headless=args.headless,
-                    delay=args.delay,
-                )
-                
-                # 生成 PDF
-                pdf_filename = f"ep{chapter.episode_num:03d}.pdf"
-                pdf_path = pdf_dir / pdf_filename
+                for chapter in chapters_to_download:
+                    # 限制同時處理的章節數，先完成最早送出的章節
+                    while in_flight and len(in_flight) >= args.chapters:
+                        finish_next()
+                    
+                    try:
+                        chapter_dir, futures = submit_chapter_images(
+                            chapter,
+                            images_dir,
+                            session,
+                            pipeline,
+                        )
+                        in_flight.append((chapter, chapter_dir, futures))
+                    except Exception as e:
+                        print(f"   ❌ 錯誤: {e}")
+                        continue
+                    
+                    # 章節間延遲
+                    time.sleep(1)
                 
-                if not pdf_path.exists():
-                    print(f"   📄 生成 PDF: {pdf_filename}")
-                    images_to_pdf(chapter_image_dir, pdf_path)
+                while in_flight:
+                    finish_next()
                 
-            except KeyboardInterrupt:
-                print("\n\n⚠️  使用者中斷")
-                sys.exit(1)
-            except Exception as e:
-                print(f"   ❌ 錯誤: {e}")
-                continue
-            
-            # 章節間延遲
-            time.sleep(1)
+                # 等待所有 PDF 生成完成
+                for chapter, chapter_dir, pdf_path, pdf_future in pdf_jobs:
+                    try:
+                        try:
+                            pdf_future.result()
+                        except BrokenProcessPool:
+                            # 行程池失效時，同一池中的其他工作也會一併失敗，重新送出一次
+                            submit_pdf(chapter_dir, pdf_path).result()
+                    except Exception as e:
+                        print(f"   ❌ 第 {chapter.episode_num} 話 PDF 錯誤: {e}")
+            finally:
+                # 中斷時取消尚未開始的工作，讓程式能儘快結束
+                pipeline.shutdown()
+                pdf_pool.shutdown(cancel_futures=True)
         
         print(f"\n🎉 完成！")
         print(f"   圖片: {images_dir}")
@@ -8,19 +8,39 @@
 2. 還原時需將圖片從底部往上取出各段，依序放到新圖的頂部往下
 """
 import hashlib
+from bisect import bisect_right
+from collections.abc import Sequence
+from functools import lru_cache
 from io import BytesIO
+from pathlib import Path
+import numpy as np
 from PIL import Image
 
 
 # 分段數映射表（index -> 實際分段數）
 SEGMENT_MAP = [2, 4, 6, 8, 10, 12, 14, 16, 18, 20]
 
+# 以 bytes 存放的映射表，索引時直接取得小整數
+_SEGMENT_MAP_B = bytes(SEGMENT_MAP)
+
 # 混淆演算法閾值
 SCRAMBLE_THRESHOLD = 220980
 RANGE_268850_421925 = (268850, 421925)
 RANGE_421926_PLUS = 421926
 
+# aid 區間的分界點與各區間取餘數的基數（0 表示不需要解混淆）：
+# [0, 220980) -> 0，[220980, 268850) -> 10，[268850, 421925] -> 10，[421926, ∞) -> 8
+_MODULUS_THRESHOLDS = (SCRAMBLE_THRESHOLD, RANGE_268850_421925[0], RANGE_421926_PLUS)
+_MODULI = (0, 10, 10, 8)
+
+# 十六進位字元的 ASCII 碼（nibble -> ord(hex 字元)），取代 hexdigest() 字串
+_HEX_ORD = b"0123456789abcdef"
+
+# WebP 編碼參數：method=0 為 libwebp 最快的編碼路徑，quality 與 Pillow 預設相同
+WEBP_SAVE_OPTIONS = {"method": 0, "quality": 80}
 
+
+@lru_cache(maxsize=8192)
 def get_num(aid: int, photo_id: str) -> int:
     """
     計算圖片的分段數量。
@@ -32,6 +52,9 @@ def get_num(aid: int, photo_id: str) -> int:
     4. 根據 aid 範圍決定取餘數的基數
     5. 用餘數作為 index 從映射表取得分段數
     
+    結果只取決於 (aid, photo_id)，因此以 lru_cache 快取，
+    重試或重複下載同一張圖片時不必重新計算。
+    
     Args:
         aid: 相簿 ID（整數）
         photo_id: 圖片編號（如 "00001"）
@@ -39,31 +62,129 @@ def get_num(aid: int, photo_id: str) -> int:
     Returns:
         int: 圖片被切割的分段數（2, 4, 6, 8, 10, 12, 14, 16, 18, 或 20）
     """
+    return get_num_b(aid, photo_id.encode("ascii"))
+
+
+def get_num_b(aid: int, photo_id: bytes) -> int:
+    """
+    get_num 的 bytes 版本：photo_id 已編碼為 ASCII bytes 時使用，
+    直接以 bytes 格式化串接，不經過中間的 str。
+    
+    Args:
+        aid: 相簿 ID（整數）
+        photo_id: 圖片編號的 ASCII bytes（如 b"00001"）
+    
+    Returns:
+        int: 圖片被切割的分段數；不需要解混淆時為 0
+    """
     # 若 aid 小於閾值，不需要解混淆
-    if aid < SCRAMBLE_THRESHOLD:
+    modulus = _segment_modulus(aid)
+    if modulus == 0:
         return 0
     
     # 計算 MD5(aid + photo_id)
-    combined = str(aid) + photo_id
-    md5_hash = hashlib.md5(combined.encode()).hexdigest()
+    combined = b"%d%s" % (aid, photo_id)
+    digest = hashlib.md5(combined, usedforsecurity=False).digest()
+    
+    # 取十六進位字串最後一個字元的 ASCII 碼：
+    # 即最後一個位元組的低 4 位元所對應的 hex 字元，不必產生整個 hexdigest 字串
+    char_code = _HEX_ORD[digest[-1] & 0x0F]
+    
+    return _SEGMENT_MAP_B[char_code % modulus]
+
+
+def get_num_batch(aid: int, photo_ids: Sequence[str]) -> list[int]:
+    """
+    批次計算同一相簿多張圖片的分段數。
+    
+    結果與逐張呼叫 get_num 相同，但與 aid 相關的判斷、編碼與雜湊只做一次。
+    
+    Args:
+        aid: 相簿 ID（整數）
+        photo_ids: 圖片編號列表（如 ["00001", "00002"]）
+    
+    Returns:
+        list[int]: 各圖片的分段數（與 photo_ids 順序相同）
+    """
+    modulus = _segment_modulus(aid)
+    if modulus == 0:
+        return [0] * len(photo_ids)
     
-    # 取最後一個字元的 ASCII 碼
-    last_char = md5_hash[-1]
-    char_code = ord(last_char)
+    # aid 前綴只吸收一次，每張圖片複製 MD5 狀態後再補上 photo_id
+    base = hashlib.md5(b"%d" % aid, usedforsecurity=False)
+    result = []
+    for photo_id in photo_ids:
+        md5 = base.copy()
+        md5.update(photo_id.encode("ascii"))
+        digest = md5.digest()
+        result.append(_SEGMENT_MAP_B[_HEX_ORD[digest[-1] & 0x0F] % modulus])
+    return result
+
+
+def _segment_modulus(aid: int) -> int:
+    """
+    根據 aid 範圍決定取餘數的基數。
     
-    # 根據 aid 範圍決定取餘數
-    if RANGE_268850_421925[0] <= aid <= RANGE_268850_421925[1]:
-        index = char_code % 10
-    elif aid >= RANGE_421926_PLUS:
-        index = char_code % 8
-    else:
-        # aid 在 220980 ~ 268849 之間，使用預設值
-        index = char_code % 10
+    Args:
+        aid: 相簿 ID（整數）
     
-    return SEGMENT_MAP[index]
+    Returns:
+        int: 取餘數的基數（8 或 10）；不需要解混淆時為 0
+    """
+    return _MODULI[bisect_right(_MODULUS_THRESHOLDS, aid)]
 
 
-def restore_image(scrambled_data: bytes, aid: int, photo_id: str) -> Image.Image:
+def descramble_rows(src: np.ndarray, num_segments: int) -> np.ndarray:
+    """
+    依列（第 0 軸）還原混淆的像素陣列。
+    
+    依照網頁 JS 邏輯，將每段從來源陣列直接複製到預先配置的輸出陣列，
+    每段只是一次連續記憶體複製，不經過 PIL crop/paste。
+    
+    原始 JS：
+    ```
+    for (var g = 0; g < c; g++) {
+        var h = Math.floor(height / c),
+            u = h * g,
+            p = height - h * (g + 1) - f;
+        if (g == 0) h += f; else u += f;
+        context.drawImage(img, 0, p, width, h, 0, u, width, h);
+    }
+    ```
+    
+    Args:
+        src: 混淆圖片的像素陣列（第 0 軸為列）
+        num_segments: 分段數（須大於 0）
+    
+    Returns:
+        np.ndarray: 還原後的像素陣列（與 src 同形狀、同型別）
+    """
+    height = src.shape[0]
+    slice_height = height // num_segments  # H_slice = floor(H / N)
+    remainder = height % num_segments      # Remainder = H % N
+    
+    dst = np.empty_like(src)
+    for g in range(num_segments):
+        h = slice_height                                 # 當前段高度
+        u = slice_height * g                             # 目標列（新圖）
+        p = height - slice_height * (g + 1) - remainder  # 來源列（原圖，從底部往上）
+        
+        if g == 0:
+            h += remainder  # 第一段加上餘數高度
+        else:
+            u += remainder  # 後續段的目標列需加上餘數偏移
+        
+        dst[u:u + h] = src[p:p + h]
+    
+    return dst
+
+
+def restore_image(
+    scrambled_data: bytes,
+    aid: int,
+    photo_id: str,
+    num_segments: int | None = None,
+) -> Image.Image:
     """
     還原被混淆的圖片。
     
@@ -93,62 +214,102 @@ def restore_image(scrambled_data: bytes, aid: int, photo_id: str) -> Image.Image
         scrambled_data: 混淆圖片的二進位資料
         aid: 相簿 ID
         photo_id: 圖片編號（如 "00001"）
+        num_segments: 已知的分段數（如由 get_num_batch 預先算好），None 時自動計算
     
     Returns:
         PIL.Image.Image: 還原後的圖片物件
     """
     # 載入圖片
     scrambled_img = Image.open(BytesIO(scrambled_data))
-    width, height = scrambled_img.size
     
     # 計算分段數
-    num_segments = get_num(aid, photo_id)
+    if num_segments is None:
+        num_segments = get_num(aid, photo_id)
     
     # 若不需要解混淆，直接返回
     if num_segments == 0:
         return scrambled_img
     
-    # 建立新的空白圖片
-    restored_img = Image.new(scrambled_img.mode, (width, height))
+    # 以原始位元組操作：每列為 tobytes() 中連續的一段，適用於任何圖片模式
+    mode = scrambled_img.mode
+    src = np.frombuffer(scrambled_img.tobytes(), dtype=np.uint8).reshape(scrambled_img.height, -1)
     
-    # 計算每段高度與餘數
-    slice_height = height // num_segments  # H_slice = floor(H / N)
-    remainder = height % num_segments      # Remainder = H % N
+    # 依列搬移各段，還原像素順序
+    restored = descramble_rows(src, num_segments)
     
-    # 依照網頁 JS 邏輯還原
-    # 原始 JS：
-    # for (var g = 0; g < c; g++) {
-    #     var h = Math.floor(height / c),
-    #         u = h * g,
-    #         p = height - h * (g + 1) - f;
-    #     if (g == 0) h += f; else u += f;
-    #     context.drawImage(img, 0, p, width, h, 0, u, width, h);
-    # }
-    for g in range(num_segments):
-        h = slice_height                           # 當前段高度
-        u = slice_height * g                       # 目標 Y 座標（新圖）
-        p = height - slice_height * (g + 1) - remainder  # 來源 Y 座標（原圖，從底部往上）
-        
-        if g == 0:
-            h += remainder  # 第一段加上餘數高度
-        else:
-            u += remainder  # 後續段的目標 Y 座標需加上餘數偏移
-        
-        # 從原圖裁切區塊
-        # crop box: (left, upper, right, lower)
-        box = (0, p, width, p + h)
-        segment = scrambled_img.crop(box)
-        
-        # 貼到新圖的目標位置
-        restored_img.paste(segment, (0, u))
+    # 直接以輸出緩衝區建立圖片，不經過 PIL paste
+    restored_img = Image.frombuffer(mode, scrambled_img.size, restored, "raw", mode, 0, 1)
+    if mode == "P":
+        restored_img.putpalette(scrambled_img.getpalette())
     
     return restored_img
 
 
+def save_image(img: Image.Image, output_path: str | Path) -> None:
+    """
+    以 WebP 格式儲存還原後的圖片（使用最快的編碼設定）。
+    
+    供下載流程使用，輸出檔案固定為 .webp；不論副檔名皆以 WebP 編碼。
+    
+    Args:
+        img: 還原後的圖片物件
+        output_path: 輸出圖片路徑
+    """
+    img.save(output_path, "WEBP", **WEBP_SAVE_OPTIONS)
+
+
+def is_webp(data: bytes) -> bool:
+    """
+    判斷資料是否為 WebP（RIFF....WEBP 檔頭）。
+    
+    只檢查前 12 個位元組，可用於串流下載的第一個區塊。
+    
+    Args:
+        data: 圖片資料（或其開頭部分）
+    
+    Returns:
+        bool: 是否為 WebP
+    """
+    return data[:4] == b"RIFF" and data[8:12] == b"WEBP"
+
+
+def restore_and_save(
+    scrambled_data: bytes,
+    aid: int,
+    photo_id: str,
+    output_path: str | Path,
+    num_segments: int | None = None,
+) -> None:
+    """
+    還原圖片並以 WebP 格式儲存（供下載流程使用）。
+    
+    若圖片不需要解混淆（分段數為 0）且原始資料已是 WebP，直接寫入原始資料，
+    省去解碼與重新編碼；其他格式仍會轉存為 WebP。
+    
+    Args:
+        scrambled_data: 混淆圖片的二進位資料
+        aid: 相簿 ID
+        photo_id: 圖片編號（如 "00001"）
+        output_path: 輸出圖片路徑
+        num_segments: 已知的分段數，None 時自動計算
+    """
+    if num_segments is None:
+        num_segments = get_num(aid, photo_id)
+    
+    if num_segments == 0 and is_webp(scrambled_data):
+        Path(output_path).write_bytes(scrambled_data)
+        return
+    
+    restored = restore_image(scrambled_data, aid, photo_id, num_segments)
+    save_image(restored, output_path)
+
+
 def restore_image_from_file(input_path: str, output_path: str, aid: int, photo_id: str) -> None:
     """
     從檔案讀取混淆圖片並還原後儲存。
     
+    輸出格式由 output_path 的副檔名決定。
+    
     Args:
         input_path: 輸入圖片路徑
         output_path: 輸出圖片路徑
@@ -158,5 +319,6 @@ def restore_image_from_file(input_path: str, output_path: str, aid: int, photo_i
     with open(input_path, "rb") as f:
         scrambled_data = f.read()
     
+    # 依輸出副檔名決定格式，不套用下載流程固定的 WebP 設定
     restored = restore_image(scrambled_data, aid, photo_id)
     restored.save(output_path)
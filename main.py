@@ -14,8 +14,8 @@ import time
 import random
 from pathlib import Path
 
-from descrambler import restore_image
-from scraper import scrape_album, download_image
+from descrambler import get_num_batch
+from scraper import BrowserSession, scrape_album, download_and_restore
 
 
 def main():
@@ -57,7 +57,8 @@ def main():
     
     try:
         # 爬取相簿資訊
-        album = scrape_album(args.url, headless=args.headless)
+        with BrowserSession(headless=args.headless) as session:
+            album = scrape_album(args.url, session)
         print(f"📚 相簿標題: {album.title}")
         print(f"🆔 相簿 ID: {album.aid}")
         print(f"🖼️  共找到 {len(album.images)} 張圖片")
@@ -70,8 +71,11 @@ def main():
         album_dir = output_dir / str(album.aid)
         album_dir.mkdir(exist_ok=True)
         
+        # 一次算好整個相簿的分段數
+        segments = get_num_batch(album.aid, [img.photo_id for img in album.images])
+        
         # 下載並還原每張圖片
-        for img_info in album.images:
+        for img_info, num_segments in zip(album.images, segments):
             # 輸出檔名：按順序編號 + 原始 photo_id
             output_filename = f"{img_info.index:04d}_{img_info.photo_id}.webp"
             output_path = album_dir / output_filename
@@ -84,14 +88,15 @@ def main():
             print(f"  📥 [{img_info.index}/{len(album.images)}] 下載中: {img_info.photo_id}...", end=" ")
             
             try:
-                # 下載圖片
-                scrambled_data = download_image(img_info.url, referer=args.url)
-                
-                # 還原圖片
-                restored_img = restore_image(scrambled_data, album.aid, img_info.photo_id)
-                
-                # 儲存
-                restored_img.save(output_path)
+                # 下載、還原並儲存
+                download_and_restore(
+                    img_info.url,
+                    album.aid,
+                    img_info.photo_id,
+                    output_path,
+                    referer=args.url,
+                    num_segments=num_segments,
+                )
                 print(f"✅ 完成")
                 
             except Exception as e:
@@ -3,12 +3,23 @@
 
 使用 Playwright 模擬瀏覽器訪問，提取圖片列表並下載。
 """
+import atexit
 import random
 import re
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
 from dataclasses import dataclass
+from io import BytesIO
+from itertools import chain
+from pathlib import Path
 from urllib.parse import urlparse
-from playwright.sync_api import sync_playwright, Page, Browser
+from playwright.sync_api import sync_playwright, Page, Browser, BrowserContext, Playwright, Route
 import httpx
+from PIL import Image
+
+from descrambler import get_num, is_webp, restore_and_save, save_image
 
 
 # 常用 User-Agent 列表
@@ -29,9 +40,35 @@ ALLOWED_DOMAINS = [
     "cdn-msp4.18comic.vip"
 ]
 
+# 從頁面 URL 提取相簿 ID、從圖片 URL 提取 photo_id
+_AID_RE = re.compile(r'/photo/(\d+)')
+_PHOTO_ID_RE = re.compile(r'/(\d+)\.\w+$')
+
 # 最大圖片大小：50MB
 MAX_IMAGE_SIZE = 50 * 1024 * 1024
 
+# Chromium 啟動參數：關閉爬取時用不到的功能，降低啟動時間與記憶體用量
+CHROMIUM_ARGS = [
+    "--disable-gpu",
+    "--disable-dev-shm-usage",
+    "--disable-accelerated-2d-canvas",
+    "--disable-extensions",
+    "--disable-background-networking",
+    "--disable-sync",
+    "--disable-default-apps",
+    "--no-first-run",
+    "--disable-features=Translate,BackForwardCache",
+    "--disable-blink-features=AutomationControlled",
+    "--blink-settings=imagesEnabled=false",
+]
+
+# 爬取時不需要的資源類型（只讀取 DOM，圖片另以 httpx 下載）
+BLOCKED_RESOURCE_TYPES = frozenset({"image", "media", "font", "stylesheet"})
+
+# 共用的 HTTP 連線（延遲建立，見 _client）
+_CLIENT: httpx.Client | None = None
+_CLIENT_LOCK = threading.Lock()
+
 
 @dataclass
 class ImageInfo:
@@ -54,6 +91,118 @@ def get_random_user_agent() -> str:
     return random.choice(USER_AGENTS)
 
 
+class RateLimiter:
+    """
+    執行緒安全的令牌桶限速器。
+    
+    多個下載執行緒共用同一個限速器，整體請求速率不超過 rate 次/秒，
+    最多允許 burst 個請求同時放行。
+    """
+    
+    def __init__(self, rate: float, burst: int = 1):
+        """
+        Args:
+            rate: 每秒補充的令牌數（即平均請求速率）
+            burst: 令牌桶容量（允許的瞬間請求數）
+        """
+        self.rate = rate
+        self.capacity = burst
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def acquire(self) -> None:
+        """取得一個令牌，若令牌不足則等待"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                
+                wait = (1 - self._tokens) / self.rate
+            
+            time.sleep(wait)
+
+
+class BrowserSession:
+    """
+    共用的 Playwright 瀏覽器工作階段。
+    
+    整個流程只啟動一次 Chromium，每次爬取頁面時建立獨立的 BrowserContext
+    （開銷遠低於重新啟動瀏覽器），用完即關閉以隔離各頁面的狀態。
+    
+    用法：
+        with BrowserSession(headless=True) as session:
+            album = scrape_album(url, session)
+    """
+    
+    def __init__(self, headless: bool = True):
+        """
+        Args:
+            headless: 是否使用無頭模式
+        """
+        self.headless = headless
+        self._pw: Playwright | None = None
+        self.browser: Browser | None = None
+    
+    def __enter__(self) -> "BrowserSession":
+        self._pw = sync_playwright().start()
+        try:
+            self.browser = self._pw.chromium.launch(headless=self.headless, args=CHROMIUM_ARGS)
+        except Exception:
+            self._pw.stop()
+            raise
+        return self
+    
+    def __exit__(self, exc_type, exc, tb) -> None:
+        try:
+            if self.browser is not None:
+                self.browser.close()
+        finally:
+            self._pw.stop()
+            self.browser = None
+            self._pw = None
+    
+    def new_page(self) -> tuple[Page, BrowserContext]:
+        """
+        建立新的 BrowserContext 與頁面。
+        
+        呼叫端用完後需自行關閉回傳的 context。
+        
+        Returns:
+            tuple[Page, BrowserContext]: (頁面, 所屬的 context)
+        """
+        context = self.browser.new_context(
+            user_agent=get_random_user_agent(),
+            viewport={"width": 1920, "height": 1080},
+        )
+        
+        # 攔截圖片、字型等資源，只載入頁面結構
+        context.route("**/*", _block_heavy_resources)
+        
+        page: Page = context.new_page()
+        
+        # 設置額外的 headers
+        page.set_extra_http_headers({
+            "Referer": "https://18comic.vip/",
+            "Accept-Language": "zh-TW,zh;q=0.9,en-US;q=0.8,en;q=0.7",
+        })
+        
+        return page, context
+
+
+def _block_heavy_resources(route: Route) -> None:
+    """Playwright 路由處理：中止不需要的資源請求，其餘照常放行"""
+    if route.request.resource_type in BLOCKED_RESOURCE_TYPES:
+        route.abort()
+    else:
+        route.continue_()
+
+
 def is_safe_url(url: str) -> bool:
     """
     驗證 URL 是否安全（白名單檢查）。
@@ -90,7 +239,7 @@ def extract_aid_from_url(url: str) -> int:
     Returns:
         int: 相簿 ID
     """
-    match = re.search(r'/photo/(\d+)', url)
+    match = _AID_RE.search(url)
     if match:
         return int(match.group(1))
     raise ValueError(f"無法從 URL 提取 aid: {url}")
@@ -106,40 +255,27 @@ def extract_photo_id_from_url(url: str) -> str:
     Returns:
         str: photo_id（如 "00001"）
     """
-    match = re.search(r'/(\d+)\.\w+$', url)
+    match = _PHOTO_ID_RE.search(url)
     if match:
         return match.group(1)
     raise ValueError(f"無法從 URL 提取 photo_id: {url}")
 
 
-def scrape_album(url: str, headless: bool = True) -> AlbumInfo:
+def scrape_album(url: str, session: BrowserSession) -> AlbumInfo:
     """
     使用 Playwright 爬取相簿頁面，提取圖片列表。
     
     Args:
         url: 相簿頁面 URL
-        headless: 是否使用無頭模式
+        session: 已啟動的瀏覽器工作階段
     
     Returns:
         AlbumInfo: 相簿資訊（包含所有圖片 URL）
     """
     aid = extract_aid_from_url(url)
     
-    with sync_playwright() as p:
-        browser: Browser = p.chromium.launch(headless=headless)
-        context = browser.new_context(
-            user_agent=get_random_user_agent(),
-            viewport={"width": 1920, "height": 1080},
-        )
-        
-        page: Page = context.new_page()
-        
-        # 設置額外的 headers
-        page.set_extra_http_headers({
-            "Referer": "https://18comic.vip/",
-            "Accept-Language": "zh-TW,zh;q=0.9,en-US;q=0.8,en;q=0.7",
-        })
-        
+    page, context = session.new_page()
+    try:
         # 訪問頁面（使用 domcontentloaded 避免等待所有資源）
         page.goto(url, wait_until="domcontentloaded", timeout=60000)
         
@@ -153,44 +289,58 @@ def scrape_album(url: str, headless: bool = True) -> AlbumInfo:
         # 捲動頁面以載入所有圖片（懶加載）
         _scroll_page(page)
         
-        # 提取頁面標題
-        title = page.title()
-        
-        # 提取所有圖片 URL
-        images = _extract_images(page, aid)
-        
-        browser.close()
+        # 提取頁面標題與所有圖片 URL（單次 evaluate）
+        title, images = _extract_images(page, aid)
+    finally:
+        context.close()
     
     return AlbumInfo(aid=aid, title=title, images=images)
 
 
-def _scroll_page(page: Page, scroll_times: int = 10, delay_ms: int = 500) -> None:
+def _scroll_page(
+    page: Page,
+    selector: str = "img[data-original], img[src*='/media/photos/']",
+    max_rounds: int = 20,
+    delay_ms: int = 200,
+) -> None:
     """
-    捲動頁面以觸發懶加載圖片。
+    捲動頁面以觸發懶加載，目標元素數量穩定後即停止。
+    
+    每輪捲動到頁面底部後等待 delay_ms，並計算符合 selector 的元素數量；
+    連續兩輪數量相同（且不為 0）即視為載入完成，不必固定等待所有輪次。
     
     Args:
         page: Playwright 頁面物件
-        scroll_times: 捲動次數
+        selector: 用來判斷載入進度的 CSS 選擇器
+        max_rounds: 最多捲動次數
         delay_ms: 每次捲動後的等待時間（毫秒）
     """
-    for _ in range(scroll_times):
-        page.evaluate("window.scrollBy(0, window.innerHeight)")
+    last_count = -1
+    for _ in range(max_rounds):
+        page.evaluate("window.scrollTo(0, document.body.scrollHeight)")
         page.wait_for_timeout(delay_ms)
+        
+        count = page.evaluate("(selector) => document.querySelectorAll(selector).length", selector)
+        if count == last_count and count > 0:
+            break
+        last_count = count
 
 
-def _extract_images(page: Page, aid: int) -> list[ImageInfo]:
+def _extract_images(page: Page, aid: int) -> tuple[str, list[ImageInfo]]:
     """
-    從頁面提取圖片資訊。
+    從頁面提取標題與圖片資訊。
+    
+    標題與圖片 URL 在同一次 evaluate 中取得，減少與瀏覽器之間的往返。
     
     Args:
         page: Playwright 頁面物件
         aid: 相簿 ID
     
     Returns:
-        list[ImageInfo]: 圖片資訊列表
+        tuple[str, list[ImageInfo]]: (頁面標題, 圖片資訊列表)
     """
-    # 使用 JavaScript 提取圖片資訊
-    image_data = page.evaluate("""
+    # 使用 JavaScript 提取頁面標題與圖片資訊
+    page_data = page.evaluate("""
         () => {
             const images = [];
             // 嘗試多種選擇器
@@ -213,32 +363,61 @@ def _extract_images(page: Page, aid: int) -> list[ImageInfo]:
             }
             
             // 去重並保持順序
-            return [...new Set(images)];
+            return { title: document.title, images: [...new Set(images)] };
         }
     """)
     
     result = []
-    for idx, url in enumerate(image_data):
+    for idx, url in enumerate(page_data["images"]):
         try:
             photo_id = extract_photo_id_from_url(url)
             result.append(ImageInfo(url=url, photo_id=photo_id, index=idx + 1))
         except ValueError:
             continue
     
-    return result
+    return page_data["title"], result
 
 
-def download_image(url: str, referer: str = "https://18comic.vip/") -> bytes:
+def _client() -> httpx.Client:
     """
-    下載圖片（包含安全驗證）。
+    取得共用的 httpx.Client（執行緒安全，首次呼叫時建立）。
+    
+    所有圖片下載共用同一個連線池，重複使用 TCP/TLS 連線並啟用 HTTP/2，
+    避免每張圖片都重新握手。
+    
+    Returns:
+        httpx.Client: 共用的 HTTP client
+    """
+    global _CLIENT
+    if _CLIENT is None:
+        with _CLIENT_LOCK:
+            if _CLIENT is None:
+                _CLIENT = httpx.Client(
+                    http2=True,
+                    follow_redirects=True,
+                    timeout=30.0,
+                    limits=httpx.Limits(
+                        max_connections=16,
+                        max_keepalive_connections=16,
+                        keepalive_expiry=60,
+                    ),
+                )
+                atexit.register(_CLIENT.close)
+    return _CLIENT
+
+
+@contextmanager
+def _stream_image(url: str, referer: str) -> Iterator[httpx.Response]:
+    """
+    以串流模式請求圖片，並完成安全驗證與 Content-Length 檢查。
     
     Args:
         url: 圖片 URL
-        referer: Referer header（必須包含 18comic.vip 域名）
+        referer: Referer header
+    
+    Yields:
+        httpx.Response: 尚未讀取內容的回應
     
-    Returns:
-        bytes: 圖片二進位資料
-        
     Raises:
         ValueError: URL 不在白名單中或檔案過大
     """
@@ -252,21 +431,128 @@ def download_image(url: str, referer: str = "https://18comic.vip/") -> bytes:
         "Accept": "image/webp,image/apng,image/*,*/*;q=0.8",
     }
     
-    with httpx.Client(follow_redirects=True, timeout=30.0) as client:
-        # 使用串流模式以檢查檔案大小
-        with client.stream("GET", url, headers=headers) as response:
-            response.raise_for_status()
-            
-            # 檢查 Content-Length header
-            content_length = response.headers.get("content-length")
-            if content_length and int(content_length) > MAX_IMAGE_SIZE:
-                raise ValueError(f"檔案過大: {content_length} bytes (最大: {MAX_IMAGE_SIZE} bytes)")
-            
-            # 分段讀取並限制總大小
-            data = b""
-            for chunk in response.iter_bytes(chunk_size=8192):
-                data += chunk
-                if len(data) > MAX_IMAGE_SIZE:
-                    raise ValueError(f"檔案大小超過限制 (最大: {MAX_IMAGE_SIZE} bytes)")
-            
-            return data
+    # 使用串流模式以檢查檔案大小
+    with _client().stream("GET", url, headers=headers) as response:
+        response.raise_for_status()
+        
+        # 檢查 Content-Length header
+        content_length = response.headers.get("content-length")
+        if content_length and int(content_length) > MAX_IMAGE_SIZE:
+            raise ValueError(f"檔案過大: {content_length} bytes (最大: {MAX_IMAGE_SIZE} bytes)")
+        
+        yield response
+
+
+def download_image(url: str, referer: str = "https://18comic.vip/") -> bytes:
+    """
+    下載圖片（包含安全驗證）。
+    
+    Args:
+        url: 圖片 URL
+        referer: Referer header（必須包含 18comic.vip 域名）
+    
+    Returns:
+        bytes: 圖片二進位資料
+        
+    Raises:
+        ValueError: URL 不在白名單中或檔案過大
+    """
+    with _stream_image(url, referer) as response:
+        # 未壓縮且已知長度（常見情況）：大小已驗證，一次讀取完整內容
+        encoding = response.headers.get("content-encoding", "identity")
+        if response.headers.get("content-length") and encoding == "identity":
+            return response.read()
+        
+        # 分段讀取並限制總大小（bytearray 擴充為均攤 O(1)，避免 bytes 串接的重複複製）
+        data = bytearray()
+        for chunk in response.iter_bytes(chunk_size=65536):
+            data += chunk
+            if len(data) > MAX_IMAGE_SIZE:
+                raise ValueError(f"檔案大小超過限制 (最大: {MAX_IMAGE_SIZE} bytes)")
+        
+        return bytes(data)
+
+
+def download_image_to_file(url: str, output_path: str | Path, referer: str = "https://18comic.vip/") -> None:
+    """
+    下載圖片並以 WebP 格式寫入檔案（包含安全驗證）。
+    
+    來源已是 WebP 時直接串流寫入，不在記憶體中保留完整內容；
+    其他格式（如 JPEG、PNG）則讀入記憶體後轉存為 WebP，
+    確保 .webp 檔案的內容與副檔名一致。
+    
+    先寫入同目錄的 .part 暫存檔，完成後再改名，
+    避免中斷時留下不完整的檔案而被誤認為已下載。
+    
+    Args:
+        url: 圖片 URL
+        output_path: 輸出檔案路徑
+        referer: Referer header（必須包含 18comic.vip 域名）
+        
+    Raises:
+        ValueError: URL 不在白名單中或檔案過大
+    """
+    output_path = Path(output_path)
+    part_path = output_path.with_name(output_path.name + ".part")
+    
+    with _stream_image(url, referer) as response:
+        try:
+            # 以第一個區塊的檔頭判斷格式（iter_bytes 除最後一塊外皆為完整大小）
+            chunks = response.iter_bytes(chunk_size=65536)
+            first = next(chunks, b"")
+            if is_webp(first):
+                written = 0
+                with open(part_path, "wb") as f:
+                    for chunk in chain((first,), chunks):
+                        written += len(chunk)
+                        if written > MAX_IMAGE_SIZE:
+                            raise ValueError(f"檔案大小超過限制 (最大: {MAX_IMAGE_SIZE} bytes)")
+                        f.write(chunk)
+            else:
+                # 來源不是 WebP：讀入記憶體後轉存為 WebP
+                data = bytearray()
+                for chunk in chain((first,), chunks):
+                    data += chunk
+                    if len(data) > MAX_IMAGE_SIZE:
+                        raise ValueError(f"檔案大小超過限制 (最大: {MAX_IMAGE_SIZE} bytes)")
+                save_image(Image.open(BytesIO(data)), part_path)
+            part_path.replace(output_path)
+        except BaseException:
+            part_path.unlink(missing_ok=True)
+            raise
+
+
+def download_and_restore(
+    url: str,
+    aid: int,
+    photo_id: str,
+    output_path: str | Path,
+    referer: str = "https://18comic.vip/",
+    num_segments: int | None = None,
+) -> None:
+    """
+    下載單張圖片、還原並儲存。
+    
+    不需解混淆時由 download_image_to_file 寫入（WebP 直接串流，完整內容不經過記憶體）；
+    需要解混淆時才下載到記憶體並還原。
+    
+    Args:
+        url: 圖片 URL
+        aid: 相簿 ID
+        photo_id: 圖片編號（如 "00001"）
+        output_path: 輸出圖片路徑
+        referer: Referer header（必須包含 18comic.vip 域名）
+        num_segments: 已知的分段數（如由 get_num_batch 預先算好），None 時自動計算
+        
+    Raises:
+        ValueError: URL 不在白名單中或檔案過大
+    """
+    if num_segments is None:
+        num_segments = get_num(aid, photo_id)
+    
+    if num_segments == 0:
+        download_image_to_file(url, output_path, referer=referer)
+        return
+    
+    scrambled_data = download_image(url, referer=referer)
+    restore_and_save(scrambled_data, aid, photo_id, output_path, num_segments)
@@ -0,0 +1,141 @@
+"""
+批量下載模組單元測試（以替身函數取代下載與還原，不連網）
+"""
+import threading
+
+import pytest
+
+import batch_download
+from batch_download import ImagePipeline
+from scraper import ImageInfo
+
+
+AID = 1223474
+REFERER = "https://18comic.vip/photo/1223474"
+
+
+def _image(index: int) -> ImageInfo:
+    """產生測試用的圖片資訊"""
+    photo_id = f"{index:05d}"
+    return ImageInfo(
+        url=f"https://cdn-msp.18comic.vip/media/photos/{AID}/{photo_id}.webp",
+        photo_id=photo_id,
+        index=index,
+    )
+
+
+def _wait_all(futures, timeout: float = 10) -> None:
+    """在背景執行緒中等待，避免管線卡住時測試永遠不結束"""
+    done = threading.Event()
+    
+    def run():
+        ImagePipeline.wait_all(futures)
+        done.set()
+    
+    threading.Thread(target=run, daemon=True).start()
+    assert done.wait(timeout), "wait_all 未在時限內完成"
+
+
+def _assert_slots_free(pipeline: ImagePipeline, count: int = 2) -> None:
+    """所有還原名額都應已釋放"""
+    slots = [pipeline._restore_slots.acquire(blocking=False) for _ in range(count)]
+    for acquired in slots:
+        if acquired:
+            pipeline._restore_slots.release()
+    assert slots == [True] * count
+
+
+@pytest.fixture
+def pipeline(monkeypatch):
+    """單一還原執行緒（2 個還原名額）的管線"""
+    monkeypatch.setattr(batch_download.os, "cpu_count", lambda: 1)
+    pipeline = ImagePipeline(workers=2, delay=0)
+    yield pipeline
+    pipeline.shutdown()
+
+
+class TestImagePipeline:
+    """測試 ImagePipeline 類別"""
+    
+    def test_downloads_and_restores(self, pipeline, monkeypatch, tmp_path):
+        """需要解混淆的圖片應下載後交給還原階段儲存"""
+        monkeypatch.setattr(batch_download, "download_image", lambda url, referer: url.encode())
+        
+        def fake_restore(data, aid, photo_id, output_path, num_segments):
+            output_path.write_bytes(data)
+        monkeypatch.setattr(batch_download, "restore_and_save", fake_restore)
+        
+        # 圖片數不超過還原名額（2 個），名額外洩時測試會失敗而非卡住
+        images = [_image(i) for i in range(1, 3)]
+        futures = [pipeline.submit(img, AID, 6, tmp_path, REFERER) for img in images]
+        _wait_all(futures)
+        
+        for img in images:
+            output_path = tmp_path / f"{img.index:04d}_{img.photo_id}.webp"
+            assert output_path.read_bytes() == img.url.encode()
+        _assert_slots_free(pipeline)
+    
+    def test_unscrambled_streams_to_file(self, pipeline, monkeypatch, tmp_path):
+        """分段數為 0 時應直接串流寫入，不經過還原階段"""
+        def fake_download_to_file(url, output_path, referer):
+            output_path.write_bytes(b"raw")
+        monkeypatch.setattr(batch_download, "download_image_to_file", fake_download_to_file)
+        
+        def fail(*args, **kwargs):
+            raise AssertionError("不應呼叫")
+        monkeypatch.setattr(batch_download, "download_image", fail)
+        monkeypatch.setattr(batch_download, "restore_and_save", fail)
+        
+        futures = [pipeline.submit(_image(1), AID, 0, tmp_path, REFERER)]
+        _wait_all(futures)
+        assert (tmp_path / "0001_00001.webp").read_bytes() == b"raw"
+    
+    def test_skips_existing_file(self, pipeline, monkeypatch, tmp_path):
+        """已存在的圖片不應重新下載"""
+        (tmp_path / "0001_00001.webp").write_bytes(b"old")
+        
+        def fail(*args, **kwargs):
+            raise AssertionError("不應呼叫")
+        monkeypatch.setattr(batch_download, "download_image", fail)
+        
+        futures = [pipeline.submit(_image(1), AID, 6, tmp_path, REFERER)]
+        _wait_all(futures)
+        assert (tmp_path / "0001_00001.webp").read_bytes() == b"old"
+    
+    def test_download_error_is_reported(self, pipeline, monkeypatch, tmp_path, capsys):
+        """下載失敗應回報錯誤，不影響其他圖片與等待"""
+        def fake_download(url, referer):
+            if url.endswith("00002.webp"):
+                raise ValueError("連線失敗")
+            return b"data"
+        monkeypatch.setattr(batch_download, "download_image", fake_download)
+        
+        def fake_restore(data, aid, photo_id, output_path, num_segments):
+            output_path.write_bytes(data)
+        monkeypatch.setattr(batch_download, "restore_and_save", fake_restore)
+        
+        futures = [pipeline.submit(_image(i), AID, 6, tmp_path, REFERER) for i in range(1, 4)]
+        _wait_all(futures)
+        
+        assert "✗ 00002: 連線失敗" in capsys.readouterr().out
+        assert sorted(p.name for p in tmp_path.iterdir()) == ["0001_00001.webp", "0003_00003.webp"]
+        _assert_slots_free(pipeline)
+    
+    def test_restore_errors_release_slots(self, pipeline, monkeypatch, tmp_path, capsys):
+        """還原失敗應回報錯誤並釋放還原名額，後續圖片不會被卡住"""
+        monkeypatch.setattr(batch_download, "download_image", lambda url, referer: b"data")
+        
+        def fake_restore(data, aid, photo_id, output_path, num_segments):
+            raise OSError("損毀的圖片")
+        monkeypatch.setattr(batch_download, "restore_and_save", fake_restore)
+        
+        futures = [pipeline.submit(_image(i), AID, 6, tmp_path, REFERER) for i in range(1, 3)]
+        _wait_all(futures)
+        
+        assert capsys.readouterr().out.count("✗") == 2
+        assert list(tmp_path.iterdir()) == []
+        _assert_slots_free(pipeline)
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -2,8 +2,46 @@
 圖片還原演算法單元測試
 """
 import hashlib
+from io import BytesIO
+
+import numpy as np
 import pytest
-from descrambler import get_num, SEGMENT_MAP
+from PIL import Image
+
+import descrambler
+from descrambler import _segment_modulus, descramble_rows, get_num, get_num_b, get_num_batch, is_webp, restore_and_save, restore_image, restore_image_from_file, SEGMENT_MAP
+
+
+def _reference_restore(img: Image.Image, num_segments: int) -> Image.Image:
+    """逐段 crop/paste 的參考實作（直接對應網頁 JS 的 drawImage 迴圈）"""
+    width, height = img.size
+    restored = Image.new(img.mode, (width, height))
+    slice_height = height // num_segments
+    remainder = height % num_segments
+    for g in range(num_segments):
+        h = slice_height
+        u = slice_height * g
+        p = height - slice_height * (g + 1) - remainder
+        if g == 0:
+            h += remainder
+        else:
+            u += remainder
+        restored.paste(img.crop((0, p, width, p + h)), (0, u))
+    return restored
+
+
+def _random_png(width: int, height: int, mode: str, seed: int) -> bytes:
+    """產生隨機像素的 PNG（無損，方便逐像素比對）"""
+    rng = np.random.default_rng(seed)
+    if mode in ("RGB", "RGBA", "LA"):
+        shape = (height, width, len(mode))
+        img = Image.fromarray(rng.integers(0, 256, shape, dtype=np.uint8), mode=mode)
+    else:
+        img = Image.fromarray(rng.integers(0, 256, (height, width), dtype=np.uint8), mode="L")
+        img = img.convert(mode)
+    buf = BytesIO()
+    img.save(buf, "PNG")
+    return buf.getvalue()
 
 
 class TestGetNum:
@@ -14,6 +52,17 @@ class TestGetNum:
         assert get_num(100000, "00001") == 0
         assert get_num(220979, "00001") == 0
     
+    def test_aid_below_threshold_skips_md5(self, monkeypatch):
+        """aid 低於閾值時應在計算 MD5 之前直接返回"""
+        def fail(*args, **kwargs):
+            raise AssertionError("aid 低於閾值時不應計算 MD5")
+        monkeypatch.setattr(descrambler.hashlib, "md5", fail)
+        get_num.cache_clear()
+        
+        assert get_num(220979, "00042") == 0
+        assert get_num_b(100000, b"00042") == 0
+        assert get_num_batch(100000, ["00001", "00002"]) == [0, 0]
+    
     def test_aid_at_threshold_returns_nonzero(self):
         """aid 達到閾值時應返回 > 0"""
         result = get_num(220980, "00001")
@@ -69,5 +118,193 @@ class TestGetNum:
             assert result in [2, 4, 6, 8, 10, 12, 14, 16]
 
 
+class TestSegmentModulus:
+    """測試 _segment_modulus 函數"""
+    
+    @pytest.mark.parametrize("aid, expected", [
+        (0, 0),
+        (220979, 0),
+        (220980, 10),
+        (268849, 10),
+        (268850, 10),
+        (421925, 10),
+        (421926, 8),
+        (1223474, 8),
+    ])
+    def test_range_boundaries(self, aid, expected):
+        """各 aid 區間邊界應對應正確的取餘數基數"""
+        assert _segment_modulus(aid) == expected
+
+
+class TestGetNumB:
+    """測試 get_num_b 函數"""
+    
+    @pytest.mark.parametrize("aid", [100000, 250000, 300000, 421926, 1223474])
+    def test_matches_get_num(self, aid):
+        """bytes 版本結果應與 get_num 相同"""
+        for i in range(1, 30):
+            photo_id = f"{i:05d}"
+            assert get_num_b(aid, photo_id.encode("ascii")) == get_num(aid, photo_id)
+    
+    def test_known_example(self):
+        """aid=1223474, photo_id=b"00001" 應返回 6"""
+        assert get_num_b(1223474, b"00001") == 6
+
+
+class TestGetNumBatch:
+    """測試 get_num_batch 函數"""
+    
+    @pytest.mark.parametrize("aid", [100000, 220980, 250000, 300000, 421925, 421926, 1223474])
+    def test_matches_get_num(self, aid):
+        """批次結果應與逐張呼叫 get_num 相同"""
+        photo_ids = [f"{i:05d}" for i in range(1, 60)]
+        assert get_num_batch(aid, photo_ids) == [get_num(aid, pid) for pid in photo_ids]
+    
+    def test_empty(self):
+        """空列表應返回空列表"""
+        assert get_num_batch(1223474, []) == []
+
+
+class TestDescrambleRows:
+    """測試 descramble_rows 函數"""
+    
+    def test_known_row_order(self):
+        """H=5, N=2：H_slice=2、餘數=1，最後一段（含餘數）移到頂部"""
+        src = np.arange(5)
+        assert descramble_rows(src, 2).tolist() == [2, 3, 4, 0, 1]
+    
+    def test_height_smaller_than_segments(self):
+        """高度小於分段數時，圖片保持不變"""
+        src = np.arange(3)
+        assert descramble_rows(src, 6).tolist() == [0, 1, 2]
+    
+    def test_preserves_shape_and_dtype(self):
+        """輸出應與輸入同形狀、同型別"""
+        src = np.zeros((10, 4, 3), dtype=np.uint8)
+        result = descramble_rows(src, 4)
+        assert result.shape == src.shape
+        assert result.dtype == src.dtype
+
+
+class TestRestoreImage:
+    """測試 restore_image 函數"""
+    
+    @pytest.mark.parametrize("mode", ["RGB", "RGBA", "L", "LA", "1", "P", "I;16"])
+    @pytest.mark.parametrize("height", [1, 5, 97, 1000, 1203])
+    def test_matches_reference(self, mode, height):
+        """還原結果應與逐段 crop/paste 的參考實作逐像素相同"""
+        aid = 1223474
+        for photo_id in ("00001", "00002", "00007"):
+            data = _random_png(13, height, mode, seed=height)
+            num_segments = get_num(aid, photo_id)
+            expected = _reference_restore(Image.open(BytesIO(data)), num_segments)
+            
+            result = restore_image(data, aid, photo_id)
+            
+            assert result.mode == mode
+            assert result.size == expected.size
+            assert result.tobytes() == expected.tobytes()
+    
+    def test_explicit_num_segments(self):
+        """傳入分段數時應直接使用，不重新計算"""
+        data = _random_png(8, 40, "RGB", seed=3)
+        expected = _reference_restore(Image.open(BytesIO(data)), 4)
+        result = restore_image(data, 1223474, "00001", num_segments=4)
+        assert result.tobytes() == expected.tobytes()
+    
+    def test_below_threshold_returns_original(self):
+        """aid 低於閾值時應原樣返回"""
+        data = _random_png(8, 40, "RGB", seed=0)
+        result = restore_image(data, 100000, "00001")
+        assert result.tobytes() == Image.open(BytesIO(data)).tobytes()
+
+
+class TestIsWebp:
+    """測試 is_webp 函數"""
+    
+    def test_webp(self):
+        """WebP 資料（含只有開頭部分）應判斷為 WebP"""
+        buf = BytesIO()
+        Image.new("RGB", (4, 4)).save(buf, "WEBP")
+        assert is_webp(buf.getvalue())
+        assert is_webp(buf.getvalue()[:12])
+    
+    @pytest.mark.parametrize("fmt", ["PNG", "JPEG", "GIF"])
+    def test_other_formats(self, fmt):
+        """其他格式不應判斷為 WebP"""
+        buf = BytesIO()
+        Image.new("RGB", (4, 4)).save(buf, fmt)
+        assert not is_webp(buf.getvalue())
+    
+    def test_short_or_other_riff(self):
+        """過短的資料或其他 RIFF 格式不應判斷為 WebP"""
+        assert not is_webp(b"")
+        assert not is_webp(b"RIFF")
+        assert not is_webp(b"RIFF\x00\x00\x00\x00WAVEfmt ")
+
+
+class TestRestoreAndSave:
+    """測試 restore_and_save 函數"""
+    
+    def test_below_threshold_writes_original_bytes(self, tmp_path):
+        """不需解混淆且來源已是 WebP 時應直接寫入原始資料，不重新編碼"""
+        buf = BytesIO()
+        Image.open(BytesIO(_random_png(8, 40, "RGB", seed=1))).save(buf, "WEBP")
+        data = buf.getvalue()
+        output_path = tmp_path / "out.webp"
+        restore_and_save(data, 100000, "00001", output_path)
+        assert output_path.read_bytes() == data
+    
+    def test_below_threshold_non_webp_is_converted(self, tmp_path):
+        """不需解混淆但來源不是 WebP 時應轉存為 WebP"""
+        data = _random_png(8, 40, "RGB", seed=1)
+        output_path = tmp_path / "out.webp"
+        restore_and_save(data, 100000, "00001", output_path)
+        
+        saved = Image.open(output_path)
+        assert saved.format == "WEBP"
+        assert saved.size == (8, 40)
+    
+    def test_scrambled_is_restored(self, tmp_path):
+        """需要解混淆時應儲存還原後的圖片"""
+        data = _random_png(8, 40, "RGB", seed=2)
+        output_path = tmp_path / "out.webp"
+        restore_and_save(data, 1223474, "00001", output_path)
+        
+        saved = Image.open(output_path)
+        assert saved.format == "WEBP"
+        assert saved.size == (8, 40)
+
+
+class TestRestoreImageFromFile:
+    """測試 restore_image_from_file 函數"""
+    
+    @pytest.mark.parametrize("aid", [100000, 1223474])
+    @pytest.mark.parametrize("suffix, fmt", [(".png", "PNG"), (".jpg", "JPEG"), (".webp", "WEBP")])
+    def test_format_follows_extension(self, tmp_path, aid, suffix, fmt):
+        """輸出格式應由副檔名決定"""
+        input_path = tmp_path / "in.png"
+        input_path.write_bytes(_random_png(8, 40, "RGB", seed=3))
+        output_path = tmp_path / f"out{suffix}"
+        
+        restore_image_from_file(str(input_path), str(output_path), aid, "00001")
+        
+        saved = Image.open(output_path)
+        assert saved.format == fmt
+        assert saved.size == (8, 40)
+    
+    def test_png_output_is_lossless(self, tmp_path):
+        """輸出 PNG 時應與還原結果完全相同"""
+        data = _random_png(8, 40, "RGB", seed=4)
+        input_path = tmp_path / "in.png"
+        input_path.write_bytes(data)
+        output_path = tmp_path / "out.png"
+        
+        restore_image_from_file(str(input_path), str(output_path), 1223474, "00001")
+        
+        expected = restore_image(data, 1223474, "00001")
+        assert Image.open(output_path).tobytes() == expected.tobytes()
+
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
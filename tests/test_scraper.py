@@ -0,0 +1,205 @@
+"""
+下載模組單元測試（以 httpx.MockTransport 模擬 CDN，不連網）
+"""
+from io import BytesIO
+
+import httpx
+import pytest
+from PIL import Image
+
+import scraper
+from scraper import RateLimiter, download_and_restore, download_image, download_image_to_file
+
+
+IMAGE_URL = "https://cdn-msp.18comic.vip/media/photos/1223474/00001.webp"
+
+
+def _image_bytes(fmt: str = "PNG", width: int = 8, height: int = 40) -> bytes:
+    """產生指定格式的純色測試圖片"""
+    buf = BytesIO()
+    Image.new("RGB", (width, height), (255, 0, 0)).save(buf, fmt)
+    return buf.getvalue()
+
+
+class _FakeClock:
+    """以 sleep 推進時間的假時鐘"""
+    
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps: list[float] = []
+    
+    def monotonic(self) -> float:
+        return self.now
+    
+    def sleep(self, seconds: float) -> None:
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def fake_clock(monkeypatch):
+    """以假時鐘取代 time.monotonic 與 time.sleep"""
+    clock = _FakeClock()
+    monkeypatch.setattr(scraper.time, "monotonic", clock.monotonic)
+    monkeypatch.setattr(scraper.time, "sleep", clock.sleep)
+    return clock
+
+
+@pytest.fixture
+def mock_cdn(monkeypatch):
+    """以固定回應取代共用的 httpx.Client"""
+    def install(handler):
+        client = httpx.Client(transport=httpx.MockTransport(handler))
+        monkeypatch.setattr(scraper, "_CLIENT", client)
+        return client
+    return install
+
+
+class TestRateLimiter:
+    """測試 RateLimiter 令牌桶"""
+    
+    def test_burst_then_throttle(self, fake_clock):
+        """前 burst 個請求應立即放行，之後依 rate 等待"""
+        limiter = RateLimiter(rate=2, burst=3)
+        for _ in range(3):
+            limiter.acquire()
+        assert fake_clock.sleeps == []
+        
+        limiter.acquire()
+        assert fake_clock.sleeps == [pytest.approx(0.5)]
+        limiter.acquire()
+        assert sum(fake_clock.sleeps) == pytest.approx(1.0)
+    
+    def test_refill_capped_at_burst(self, fake_clock):
+        """閒置再久，累積的令牌也不超過 burst"""
+        limiter = RateLimiter(rate=1, burst=2)
+        limiter.acquire()
+        limiter.acquire()
+        
+        fake_clock.now += 100
+        limiter.acquire()
+        limiter.acquire()
+        assert fake_clock.sleeps == []
+        
+        limiter.acquire()
+        assert fake_clock.sleeps == [pytest.approx(1.0)]
+    
+    def test_average_rate(self, fake_clock):
+        """連續請求的平均速率應為 rate 次/秒"""
+        limiter = RateLimiter(rate=4, burst=1)
+        start = fake_clock.now
+        for _ in range(21):
+            limiter.acquire()
+        assert fake_clock.now - start == pytest.approx(5.0)
+
+
+class TestDownloadImage:
+    """測試 download_image 函數"""
+    
+    def test_returns_body(self, mock_cdn):
+        """應返回完整的回應內容"""
+        mock_cdn(lambda request: httpx.Response(200, content=b"webp-data"))
+        assert download_image(IMAGE_URL) == b"webp-data"
+    
+    def test_streamed_body_without_content_length(self, mock_cdn):
+        """沒有 Content-Length 時應分段讀取完整內容"""
+        chunks = [b"a" * 70000, b"b" * 70000, b"c"]
+        mock_cdn(lambda request: httpx.Response(200, content=iter(chunks)))
+        assert download_image(IMAGE_URL) == b"".join(chunks)
+    
+    def test_rejects_unsafe_url(self):
+        """不在白名單中的 URL 應被拒絕"""
+        with pytest.raises(ValueError):
+            download_image("https://example.com/00001.webp")
+    
+    def test_rejects_oversized_stream(self, mock_cdn, monkeypatch):
+        """串流內容超過大小限制時應報錯"""
+        monkeypatch.setattr(scraper, "MAX_IMAGE_SIZE", 100)
+        mock_cdn(lambda request: httpx.Response(200, content=iter([b"x" * 80, b"x" * 80])))
+        with pytest.raises(ValueError):
+            download_image(IMAGE_URL)
+
+
+class TestDownloadImageToFile:
+    """測試 download_image_to_file 函數"""
+    
+    def test_webp_written_verbatim(self, mock_cdn, tmp_path):
+        """WebP 來源應原樣寫入檔案，且不留下暫存檔"""
+        data = _image_bytes("WEBP")
+        mock_cdn(lambda request: httpx.Response(200, content=iter([data[:5], data[5:]])))
+        output_path = tmp_path / "0001_00001.webp"
+        download_image_to_file(IMAGE_URL, output_path)
+        assert output_path.read_bytes() == data
+        assert [p.name for p in tmp_path.iterdir()] == ["0001_00001.webp"]
+    
+    @pytest.mark.parametrize("fmt", ["PNG", "JPEG"])
+    def test_non_webp_is_converted(self, mock_cdn, tmp_path, fmt):
+        """非 WebP 來源應轉存為 WebP，且不留下暫存檔"""
+        mock_cdn(lambda request: httpx.Response(200, content=_image_bytes(fmt)))
+        output_path = tmp_path / "0001_00001.webp"
+        download_image_to_file(IMAGE_URL, output_path)
+        
+        saved = Image.open(output_path)
+        assert saved.format == "WEBP"
+        assert saved.size == (8, 40)
+        assert [p.name for p in tmp_path.iterdir()] == ["0001_00001.webp"]
+    
+    def test_oversized_leaves_no_file(self, mock_cdn, monkeypatch, tmp_path):
+        """超過大小限制時不應留下任何檔案"""
+        monkeypatch.setattr(scraper, "MAX_IMAGE_SIZE", 100)
+        mock_cdn(lambda request: httpx.Response(200, content=iter([b"x" * 80, b"x" * 80])))
+        with pytest.raises(ValueError):
+            download_image_to_file(IMAGE_URL, tmp_path / "0001_00001.webp")
+        assert list(tmp_path.iterdir()) == []
+    
+    def test_oversized_webp_leaves_no_file(self, mock_cdn, monkeypatch, tmp_path):
+        """WebP 串流超過大小限制時不應留下任何檔案"""
+        monkeypatch.setattr(scraper, "MAX_IMAGE_SIZE", 100)
+        header = b"RIFF\x00\x00\x00\x00WEBP"
+        mock_cdn(lambda request: httpx.Response(200, content=iter([header + b"x" * 80, b"x" * 80])))
+        with pytest.raises(ValueError):
+            download_image_to_file(IMAGE_URL, tmp_path / "0001_00001.webp")
+        assert list(tmp_path.iterdir()) == []
+    
+    def test_invalid_image_leaves_no_file(self, mock_cdn, tmp_path):
+        """無法辨識的內容應報錯且不留下任何檔案"""
+        mock_cdn(lambda request: httpx.Response(200, content=b"not an image"))
+        with pytest.raises(OSError):
+            download_image_to_file(IMAGE_URL, tmp_path / "0001_00001.webp")
+        assert list(tmp_path.iterdir()) == []
+
+
+class TestDownloadAndRestore:
+    """測試 download_and_restore 函數"""
+    
+    def test_unscrambled_is_written_verbatim(self, mock_cdn, tmp_path):
+        """aid 低於閾值且來源為 WebP 時應原樣寫入下載內容"""
+        data = _image_bytes("WEBP")
+        mock_cdn(lambda request: httpx.Response(200, content=data))
+        output_path = tmp_path / "out.webp"
+        download_and_restore(IMAGE_URL, 100000, "00001", output_path)
+        assert output_path.read_bytes() == data
+    
+    @pytest.mark.parametrize("fmt", ["PNG", "JPEG"])
+    def test_unscrambled_non_webp_is_converted(self, mock_cdn, tmp_path, fmt):
+        """aid 低於閾值但來源不是 WebP 時，輸出仍應是真正的 WebP"""
+        mock_cdn(lambda request: httpx.Response(200, content=_image_bytes(fmt)))
+        output_path = tmp_path / "out.webp"
+        download_and_restore(IMAGE_URL, 100000, "00001", output_path)
+        
+        saved = Image.open(output_path)
+        assert saved.format == "WEBP"
+        assert saved.size == (8, 40)
+    
+    def test_scrambled_is_restored(self, mock_cdn, tmp_path):
+        """需要解混淆時應儲存還原後的 WebP"""
+        mock_cdn(lambda request: httpx.Response(200, content=_image_bytes()))
+        output_path = tmp_path / "out.webp"
+        download_and_restore(IMAGE_URL, 1223474, "00001", output_path)
+        saved = Image.open(output_path)
+        assert saved.format == "WEBP"
+        assert saved.size == (8, 40)
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
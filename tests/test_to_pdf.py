@@ -0,0 +1,151 @@
+"""
+圖片轉 PDF 模組單元測試
+"""
+import numpy as np
+import pytest
+from PIL import Image, PdfParser
+
+from to_pdf import _flatten_rgba_to_rgb_np, images_to_pdf
+
+
+def _save_image(path, mode: str = "RGB", size: tuple[int, int] = (50, 80)) -> None:
+    """產生測試圖片"""
+    color = {"RGB": (255, 0, 0), "RGBA": (0, 255, 0, 128), "L": 128, "P": 3}[mode]
+    Image.new(mode, size, color).save(path)
+
+
+class TestFlattenRgbaToRgb:
+    """測試 _flatten_rgba_to_rgb_np 函數"""
+    
+    def test_matches_paste_on_white(self):
+        """結果應與以 alpha 遮罩貼到白色背景上相同（容許 ±1 的捨入差）"""
+        rng = np.random.default_rng(0)
+        img = Image.fromarray(rng.integers(0, 256, (37, 23, 4), dtype=np.uint8), "RGBA")
+        expected = Image.new("RGB", img.size, (255, 255, 255))
+        expected.paste(img, mask=img.getchannel("A"))
+        
+        result = _flatten_rgba_to_rgb_np(img)
+        
+        assert result.mode == "RGB"
+        diff = np.asarray(result, dtype=np.int16) - np.asarray(expected, dtype=np.int16)
+        assert np.abs(diff).max() <= 1
+    
+    def test_opaque_and_transparent(self):
+        """不透明像素保持原色，完全透明像素變為白色"""
+        arr = np.array([[[10, 20, 30, 255], [10, 20, 30, 0]]], dtype=np.uint8)
+        result = _flatten_rgba_to_rgb_np(Image.fromarray(arr, "RGBA"))
+        assert np.asarray(result).tolist() == [[[10, 20, 30], [255, 255, 255]]]
+    
+    def test_palette_with_transparency(self):
+        """P 模式的透明色應合成為白色"""
+        img = Image.new("P", (2, 1), 0)
+        img.putpalette([0, 0, 0, 200, 100, 50])
+        img.putpixel((1, 0), 1)
+        img.info["transparency"] = 0
+        result = _flatten_rgba_to_rgb_np(img)
+        assert np.asarray(result).tolist() == [[[255, 255, 255], [200, 100, 50]]]
+
+
+class TestImagesToPdf:
+    """測試 images_to_pdf 函數"""
+    
+    def test_pages_in_order(self, tmp_path):
+        """每張圖片應成為一頁，頁面尺寸依 100 DPI 換算"""
+        image_dir = tmp_path / "images"
+        image_dir.mkdir()
+        _save_image(image_dir / "0002.png", size=(100, 200))
+        _save_image(image_dir / "0001.webp", mode="RGBA", size=(50, 80))
+        _save_image(image_dir / "0003.png", mode="P", size=(60, 60))
+        _save_image(image_dir / "0004.png", mode="L", size=(20, 10))
+        (image_dir / "notes.txt").write_text("not an image")
+        output_path = tmp_path / "album.pdf"
+        
+        images_to_pdf(image_dir, output_path)
+        
+        pdf = PdfParser.PdfParser(str(output_path))
+        boxes = [pdf.read_indirect(page)[b"MediaBox"] for page in pdf.pages]
+        assert boxes == [
+            [0, 0, 36.0, 57.6],
+            [0, 0, 72.0, 144.0],
+            [0, 0, 43.2, 43.2],
+            [0, 0, 14.4, 7.2],
+        ]
+        pdf.close()
+        assert sorted(p.name for p in tmp_path.iterdir()) == ["album.pdf", "images"]
+    
+    def test_natural_order(self, tmp_path):
+        """檔名中的數字應依數值排序，而非字典序"""
+        image_dir = tmp_path / "images"
+        image_dir.mkdir()
+        for i in range(1, 12):
+            _save_image(image_dir / f"{i}.png", size=(10, 10 * i))
+        (image_dir / "sub.png").mkdir()
+        output_path = tmp_path / "album.pdf"
+        
+        images_to_pdf(image_dir, output_path)
+        
+        pdf = PdfParser.PdfParser(str(output_path))
+        heights = [pdf.read_indirect(page)[b"MediaBox"][3] for page in pdf.pages]
+        assert heights == pytest.approx([7.2 * i for i in range(1, 12)])
+        pdf.close()
+    
+    def test_jpeg_embedded_verbatim(self, tmp_path):
+        """RGB 與灰階 JPEG 應直接嵌入原始內容，不重新壓縮"""
+        image_dir = tmp_path / "images"
+        image_dir.mkdir()
+        _save_image(image_dir / "0001.jpg", size=(30, 40))
+        _save_image(image_dir / "0002.jpeg", mode="L", size=(30, 40))
+        output_path = tmp_path / "album.pdf"
+        
+        images_to_pdf(image_dir, output_path)
+        
+        pdf = PdfParser.PdfParser(str(output_path))
+        for page, name, color_space in zip(
+            pdf.pages, ["0001.jpg", "0002.jpeg"], [b"DeviceRGB", b"DeviceGray"]
+        ):
+            xobject = pdf.read_indirect(page)[b"Resources"][b"XObject"][b"image"]
+            image = pdf.read_indirect(xobject)
+            assert image.dictionary.ColorSpace == PdfParser.PdfName(color_space)
+            assert bytes(image.buf) == (image_dir / name).read_bytes()
+        pdf.close()
+    
+    def test_max_dim(self, tmp_path):
+        """超過 max_dim 的圖片（包括 JPEG）應等比例縮小並重新編碼，較小的圖片保持原尺寸"""
+        image_dir = tmp_path / "images"
+        image_dir.mkdir()
+        _save_image(image_dir / "0001.png", size=(100, 400))
+        _save_image(image_dir / "0002.jpg", size=(300, 150))
+        _save_image(image_dir / "0003.png", size=(50, 80))
+        output_path = tmp_path / "album.pdf"
+        
+        images_to_pdf(image_dir, output_path, max_dim=200)
+        
+        pdf = PdfParser.PdfParser(str(output_path))
+        sizes = []
+        for page in pdf.pages:
+            xobject = pdf.read_indirect(page)[b"Resources"][b"XObject"][b"image"]
+            image = pdf.read_indirect(xobject).dictionary
+            sizes.append((image.Width, image.Height))
+        assert sizes == [(50, 200), (200, 100), (50, 80)]
+        pdf.close()
+    
+    def test_empty_dir(self, tmp_path):
+        """沒有圖片時應報錯且不產生檔案"""
+        with pytest.raises(ValueError):
+            images_to_pdf(tmp_path, tmp_path / "album.pdf")
+        assert list(tmp_path.iterdir()) == []
+    
+    def test_failed_page_leaves_no_file(self, tmp_path):
+        """圖片損毀時不應留下不完整的 PDF"""
+        image_dir = tmp_path / "images"
+        image_dir.mkdir()
+        _save_image(image_dir / "0001.png")
+        (image_dir / "0002.png").write_bytes(b"broken")
+        
+        with pytest.raises(OSError):
+            images_to_pdf(image_dir, tmp_path / "album.pdf")
+        assert [p.name for p in tmp_path.iterdir()] == ["images"]
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -5,60 +5,258 @@
 將指定目錄中的圖片合併成一個可連續觀看的 PDF 檔案。
 """
 import argparse
+import os
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from itertools import islice
 from pathlib import Path
+from typing import BinaryIO
+
+import numpy as np
 from PIL import Image
 
 
-def images_to_pdf(image_dir: Path, output_path: Path) -> None:
+# PDF 頁面解析度（DPI），決定頁面的實體尺寸
+PDF_RESOLUTION = 100.0
+
+# 支援的圖片格式
+IMAGE_EXTENSIONS = frozenset({".webp", ".png", ".jpg", ".jpeg", ".gif", ".bmp"})
+
+_DIGITS_RE = re.compile(r"(\d+)")
+
+
+def _natural_key(name: str) -> list[str | int]:
+    """
+    自然排序鍵：檔名中的數字依數值比較（如 9.webp 排在 10.webp 之前）。
+    
+    Args:
+        name: 檔名
+    
+    Returns:
+        list: 文字與數字交錯的排序鍵
+    """
+    return [int(part) if part.isdigit() else part.lower() for part in _DIGITS_RE.split(name)]
+
+
+def _flatten_rgba_to_rgb_np(img: Image.Image) -> Image.Image:
+    """
+    將帶透明度的圖片以單次 NumPy 運算合成到白色背景上。
+    
+    Args:
+        img: RGBA、LA 或 P 模式的圖片
+    
+    Returns:
+        Image.Image: RGB 圖片
+    """
+    arr = np.asarray(img.convert("RGBA"), dtype=np.uint8)
+    rgb = arr[..., :3].astype(np.uint16)
+    alpha = arr[..., 3:4].astype(np.uint16)
+    out = (rgb * alpha + 255 * (255 - alpha) + 127) // 255
+    return Image.fromarray(out.astype(np.uint8), "RGB")
+
+
+def _load_rgb(img_path: str | Path, max_dim: int = 0) -> Image.Image:
+    """
+    載入圖片並轉換為 RGB（PDF 需要）。
+    
+    於工作執行緒中執行，並在返回前完成解碼。
+    
+    Args:
+        img_path: 圖片路徑
+        max_dim: 最長邊的像素上限，超過時等比例縮小；0 表示保持原尺寸
+    
+    Returns:
+        Image.Image: 已解碼的 RGB 圖片
+    """
+    img = Image.open(img_path)
+    # 轉換為 RGB（透明部分以白色背景合成）
+    if img.mode in ("RGBA", "P", "LA"):
+        img = _flatten_rgba_to_rgb_np(img)
+    elif img.mode != "RGB":
+        img = img.convert("RGB")
+    
+    if max_dim and max(img.size) > max_dim:
+        img.thumbnail((max_dim, max_dim), Image.Resampling.LANCZOS)
+    
+    # 強制在此執行緒中解碼（Image.open 只讀取檔頭）
+    img.load()
+    return img
+
+
+# 可直接嵌入 PDF（DCTDecode）的 JPEG 色彩模式與對應色彩空間
+_JPEG_COLOR_SPACES = {"RGB": b"DeviceRGB", "L": b"DeviceGray"}
+
+
+def _encode_page(img_path: str | Path, max_dim: int = 0) -> tuple[int, int, bytes, bytes]:
+    """
+    載入圖片並編碼為 PDF 頁面使用的 JPEG。
+    
+    來源本身是 RGB 或灰階 JPEG 且不需縮小時直接沿用原始檔案內容，
+    不解碼也不重新壓縮。
+    
+    Args:
+        img_path: 圖片路徑
+        max_dim: 最長邊的像素上限，0 表示保持原尺寸
+    
+    Returns:
+        tuple: (寬度, 高度, 色彩空間, JPEG 資料)
+    """
+    with open(img_path, "rb") as f:
+        img = Image.open(f)
+        if (
+            img.format == "JPEG"
+            and img.mode in _JPEG_COLOR_SPACES
+            and not (max_dim and max(img.size) > max_dim)
+        ):
+            f.seek(0)
+            return img.width, img.height, _JPEG_COLOR_SPACES[img.mode], f.read()
+    
+    img = _load_rgb(img_path, max_dim)
+    buf = BytesIO()
+    img.save(buf, "JPEG")
+    return img.width, img.height, b"DeviceRGB", buf.getvalue()
+
+
+class _PdfWriter:
+    """
+    逐頁寫入的 PDF 產生器。
+    
+    每頁為一張 DCTDecode（JPEG）影像，寫入後即可釋放，
+    不需像 Image.save(save_all=True) 一樣先持有所有頁面。
+    """
+    
+    def __init__(self, fp: BinaryIO, title: str = "", resolution: float = PDF_RESOLUTION):
+        """
+        Args:
+            fp: 以二進位模式開啟的輸出檔案
+            title: PDF 標題
+            resolution: 頁面解析度（DPI）
+        """
+        self._fp = fp
+        self._title = title
+        self._scale = 72.0 / resolution
+        self._offsets: dict[int, int] = {}
+        self._page_ids: list[int] = []
+        # 1: Catalog，2: Pages（於 close() 時寫入）
+        self._next_id = 3
+        fp.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+    
+    def _new_id(self) -> int:
+        obj_id = self._next_id
+        self._next_id += 1
+        return obj_id
+    
+    def _write_obj(self, obj_id: int, body: bytes, stream: bytes | None = None) -> None:
+        self._offsets[obj_id] = self._fp.tell()
+        self._fp.write(b"%d 0 obj\n" % obj_id)
+        self._fp.write(body)
+        if stream is not None:
+            self._fp.write(b"\nstream\n")
+            self._fp.write(stream)
+            self._fp.write(b"\nendstream")
+        self._fp.write(b"\nendobj\n")
+    
+    def add_page(self, width: int, height: int, color_space: bytes, jpeg_data: bytes) -> None:
+        """
+        新增一頁 JPEG 影像。
+        
+        Args:
+            width: 影像寬度（像素）
+            height: 影像高度（像素）
+            color_space: PDF 色彩空間（DeviceRGB 或 DeviceGray）
+            jpeg_data: JPEG 資料
+        """
+        image_id = self._new_id()
+        contents_id = self._new_id()
+        page_id = self._new_id()
+        page_width = width * self._scale
+        page_height = height * self._scale
+        
+        self._write_obj(
+            image_id,
+            b"<< /Type /XObject /Subtype /Image /Width %d /Height %d "
+            b"/ColorSpace /%s /BitsPerComponent 8 /Filter /DCTDecode "
+            b"/Length %d >>" % (width, height, color_space, len(jpeg_data)),
+            jpeg_data,
+        )
+        contents = b"q %f 0 0 %f 0 0 cm /image Do Q\n" % (page_width, page_height)
+        self._write_obj(contents_id, b"<< /Length %d >>" % len(contents), contents)
+        self._write_obj(
+            page_id,
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %f %f] "
+            b"/Resources << /ProcSet [/PDF /ImageC /ImageB] /XObject << /image %d 0 R >> >> "
+            b"/Contents %d 0 R >>" % (page_width, page_height, image_id, contents_id),
+        )
+        self._page_ids.append(page_id)
+    
+    def close(self) -> None:
+        """寫入頁面目錄、文件資訊與交叉參照表"""
+        self._write_obj(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+        kids = b" ".join(b"%d 0 R" % page_id for page_id in self._page_ids)
+        self._write_obj(2, b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(self._page_ids)))
+        info_id = self._new_id()
+        title = ("\ufeff" + self._title).encode("utf-16-be").hex().encode("ascii")
+        self._write_obj(info_id, b"<< /Title <%s> >>" % title)
+        
+        xref_offset = self._fp.tell()
+        size = self._next_id
+        self._fp.write(b"xref\n0 %d\n0000000000 65535 f \n" % size)
+        for obj_id in range(1, size):
+            self._fp.write(b"%010d 00000 n \n" % self._offsets[obj_id])
+        self._fp.write(
+            b"trailer\n<< /Size %d /Root 1 0 R /Info %d 0 R >>\n"
+            b"startxref\n%d\n%%%%EOF\n" % (size, info_id, xref_offset)
+        )
+
+
+def images_to_pdf(image_dir: Path, output_path: Path, max_dim: int = 0) -> None:
     """
     將目錄中的圖片合併成 PDF。
     
     Args:
         image_dir: 圖片目錄
         output_path: 輸出 PDF 路徑
+        max_dim: 頁面最長邊的像素上限，超過時等比例縮小；0 表示保持原尺寸
     """
-    # 支援的圖片格式
-    extensions = {".webp", ".png", ".jpg", ".jpeg", ".gif", ".bmp"}
-    
-    # 取得所有圖片並排序
-    image_files = sorted(
-        [f for f in image_dir.iterdir() if f.suffix.lower() in extensions]
-    )
+    # 取得所有圖片並依檔名自然排序
+    with os.scandir(image_dir) as it:
+        image_files = [
+            entry for entry in it
+            if os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS and entry.is_file()
+        ]
+    image_files.sort(key=lambda entry: _natural_key(entry.name))
     
     if not image_files:
         raise ValueError(f"目錄 {image_dir} 中未找到圖片")
     
     print(f"📚 找到 {len(image_files)} 張圖片")
     
-    # 載入所有圖片並轉換為 RGB（PDF 需要）
-    images = []
-    for img_path in image_files:
-        img = Image.open(img_path)
-        # 轉換為 RGB（處理 RGBA 或其他模式）
-        if img.mode in ("RGBA", "P", "LA"):
-            # 建立白色背景
-            background = Image.new("RGB", img.size, (255, 255, 255))
-            if img.mode == "P":
-                img = img.convert("RGBA")
-            background.paste(img, mask=img.split()[-1] if img.mode == "RGBA" else None)
-            img = background
-        elif img.mode != "RGB":
-            img = img.convert("RGB")
-        images.append(img)
-        print(f"  ✓ 載入: {img_path.name}")
-    
-    # 第一張圖片作為基底，其餘附加
-    first_image = images[0]
-    other_images = images[1:]
-    
-    # 儲存為 PDF
-    first_image.save(
-        output_path,
-        "PDF",
-        resolution=100.0,
-        save_all=True,
-        append_images=other_images,
-    )
+    # 以執行緒池並行解碼、轉換並編碼頁面，最多預先處理 lookahead 張；
+    # 每頁寫入後即釋放，記憶體用量與圖片總數無關
+    workers = os.cpu_count() or 1
+    lookahead = workers * 2
+    part_path = output_path.with_name(output_path.name + ".part")
+    try:
+        with open(part_path, "wb") as f, ThreadPoolExecutor(max_workers=workers) as pool:
+            writer = _PdfWriter(f, title=output_path.stem)
+            remaining = iter(image_files)
+            pending = deque(
+                (entry.name, pool.submit(_encode_page, entry.path, max_dim))
+                for entry in islice(remaining, lookahead)
+            )
+            while pending:
+                name, future = pending.popleft()
+                writer.add_page(*future.result())
+                print(f"  ✓ 載入: {name}")
+                for entry in islice(remaining, 1):
+                    pending.append((entry.name, pool.submit(_encode_page, entry.path, max_dim)))
+            writer.close()
+        part_path.replace(output_path)
+    except BaseException:
+        part_path.unlink(missing_ok=True)
+        raise
     
     print(f"\n🎉 PDF 已儲存至: {output_path}")
 
@@ -76,6 +274,12 @@ def main():
         "--output", "-o",
         help="輸出 PDF 路徑（預設：{目錄名}.pdf）",
     )
+    parser.add_argument(
+        "--max-dim",
+        type=int,
+        default=0,
+        help="頁面最長邊的像素上限，超過時等比例縮小（預設：0，保持原尺寸）",
+    )
     
     args = parser.parse_args()
     
@@ -90,7 +294,7 @@ def main():
     else:
         output_path = image_dir.parent / f"{image_dir.name}.pdf"
     
-    images_to_pdf(image_dir, output_path)
+    images_to_pdf(image_dir, output_path, max_dim=args.max_dim)
     return 0
 
 